@@ -3,49 +3,71 @@
 Lightweight bot base class for connecting to the CMI simulated exchange.
 """
 
-import json
+import os
 import time
 from abc import ABC, abstractmethod
 from collections.abc import Mapping
-from dataclasses import asdict, dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
 from enum import StrEnum
 from functools import cached_property
-from threading import Thread
+from operator import attrgetter, neg
+from pathlib import Path
+from threading import Event, Lock, Thread
 from traceback import format_exc
-from typing import Any, Callable, Literal
+from typing import Any, Callable, Iterator, Literal, NamedTuple
+from urllib.parse import urlsplit
 
+import orjson
 import requests
-import sseclient
+from requests.adapters import HTTPAdapter
+from sortedcontainers import SortedDict
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 STANDARD_HEADERS = {"Content-Type": "application/json; charset=utf-8"}
+MAX_IN_FLIGHT = 32  # concurrent REST requests; also the keep-alive pool size
+POSITION_SYNC_INTERVAL = 2.0  # seconds between REST reconciliations of local positions
+FAN_OUT_RATE = 10.0  # sustained requests/second for concurrent fan-out, bursting up to this many
+PRODUCTS_CACHE_DIR = Path.home() / ".cache" / "imcooked"
+PRODUCTS_CACHE_TTL = 3600  # seconds before the on-disk product list is refetched
 
 
 class DictLikeFrozenDataclassMapping(Mapping):
     """Mixin class to allow frozen dataclasses behave like a dict."""
 
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Resolve the field names once per class instead of on every access
+        cls._field_names = tuple(cls.__annotations__)
+        cls._get_values = attrgetter(*cls._field_names) if len(cls._field_names) > 1 else None
+
     def __getitem__(self, key: str) -> Any:
         return getattr(self, key)
 
     def __iter__(self):
-        return iter(self.__annotations__)
+        return iter(self._field_names)
 
     def __len__(self) -> int:
-        return len(self.__annotations__)
+        return len(self._field_names)
 
     def to_dict(self) -> dict:
         return asdict(self)
 
     def keys(self):
-        return self.__annotations__.keys()
+        return self._field_names
 
     def values(self):
-        return [getattr(self, k) for k in self.keys()]
+        if self._get_values is None:
+            return tuple(getattr(self, k) for k in self._field_names)
+        return self._get_values(self)
 
     def items(self):
-        return [(k, getattr(self, k)) for k in self.keys()]
+        return tuple(zip(self._field_names, self.values()))
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Product(DictLikeFrozenDataclassMapping):
     symbol: str
     tickSize: float
@@ -53,7 +75,7 @@ class Product(DictLikeFrozenDataclassMapping):
     contractSize: int
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Trade(DictLikeFrozenDataclassMapping):
     timestamp: str
     product: str
@@ -63,19 +85,30 @@ class Trade(DictLikeFrozenDataclassMapping):
     price: float
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Order(DictLikeFrozenDataclassMapping):
     price: float
     volume: int
     own_volume: int
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class OrderBook(DictLikeFrozenDataclassMapping):
     product: str
     tick_size: float
     buy_orders: list[Order]
     sell_orders: list[Order]
+    # Top of book, resolved once at construction (both sides are kept best-first)
+    best_bid: float | None = field(init=False, default=None)
+    best_ask: float | None = field(init=False, default=None)
+
+    def __post_init__(self):
+        object.__setattr__(self, "best_bid", self.buy_orders[0].price if self.buy_orders else None)
+        object.__setattr__(self, "best_ask", self.sell_orders[0].price if self.sell_orders else None)
+
+    def top(self) -> tuple[float | None, float | None]:
+        """(best_bid, best_ask) in one call; either is None when that side is empty."""
+        return self.best_bid, self.best_ask
 
 
 class Side(StrEnum):
@@ -83,15 +116,14 @@ class Side(StrEnum):
     SELL = "SELL"
 
 
-@dataclass(frozen=True)
-class OrderRequest:
+class OrderRequest(NamedTuple):
     product: str
     price: float
     side: Side
     volume: int
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class OrderResponse:
     id: str
     status: Literal["ACTIVE", "PART_FILLED"]
@@ -106,6 +138,63 @@ class OrderResponse:
     message: str | None = None
 
 
+def _trade_from_json(raw: dict[str, Any]) -> Trade:
+    """Build a Trade from an exchange payload, ignoring any extra keys."""
+    return Trade(raw["timestamp"], raw["product"], raw["buyer"], raw["seller"], raw["volume"], raw["price"])
+
+
+class _BookSide:
+    """Price levels for one side of a streamed book, kept sorted between updates."""
+
+    def __init__(self, descending: bool):
+        self._levels: SortedDict = SortedDict(neg) if descending else SortedDict()
+
+    def apply(self, raw_levels: dict[str, dict[str, int]]) -> list[Order]:
+        """Amend the levels in place to match a snapshot and return them best-first.
+
+        The snapshot is diffed against the previous one so that only levels that
+        appeared, vanished or changed volume are touched; untouched levels keep
+        their existing Order objects.
+        """
+        levels = self._levels
+        incoming = {float(price): v for price, v in raw_levels.items()}
+        for price in [p for p in levels if p not in incoming]:
+            del levels[price]
+        for price, v in incoming.items():
+            volume, own_volume = v["marketVolume"], v["userVolume"]
+            level = levels.get(price)
+            if level is None or level.volume != volume or level.own_volume != own_volume:
+                levels[price] = Order(price=price, volume=volume, own_volume=own_volume)
+        return list(levels.values())
+
+
+def _iter_sse_frames(response: requests.Response) -> Iterator[tuple[bytes, bytes]]:
+    """Yield (event, data) pairs from a text/event-stream body without decoding it.
+
+    Frames are split on blank lines straight off the socket; data lines are
+    joined with newlines and handed back as raw bytes for orjson.
+    """
+    read = response.raw.read1
+    buffer = bytearray()
+    while chunk := read(65536, decode_content=True):
+        buffer += chunk
+        if b"\r" in buffer:
+            buffer = buffer.replace(b"\r\n", b"\n")
+        start = 0
+        while (end := buffer.find(b"\n\n", start)) != -1:
+            event = b"message"
+            data: list[bytes] = []
+            for line in bytes(buffer[start:end]).split(b"\n"):
+                if line.startswith(b"data:"):
+                    data.append(line[6:] if line.startswith(b"data: ") else line[5:])
+                elif line.startswith(b"event:"):
+                    event = line[6:].strip()
+            start = end + 2
+            if data:
+                yield event, b"\n".join(data)
+        del buffer[:start]
+
+
 class _SSEThread(Thread):
     """Background thread that consumes the CMI SSE stream and dispatches events."""
 
@@ -122,14 +211,20 @@ class _SSEThread(Thread):
         self._handle_orderbook = handle_orderbook
         self._handle_trade_event = handle_trade_event
         self._http_stream: requests.Response | None = None
-        self._client: sseclient.SSEClient | None = None
         self._closed = False
+        # product -> (bids, asks), amended in place by each order event
+        self._books: dict[str, tuple[_BookSide, _BookSide]] = {}
 
     def run(self):
         while not self._closed:
             try:
                 self._consume()
-            except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError):
+            except (
+                requests.exceptions.ReadTimeout,
+                requests.exceptions.ConnectionError,
+                ReadTimeoutError,
+                ProtocolError,
+            ):
                 pass
             except Exception:
                 if not self._closed:
@@ -140,8 +235,6 @@ class _SSEThread(Thread):
         self._closed = True
         if self._http_stream:
             self._http_stream.close()
-        if self._client:
-            self._client.close()
 
     def _consume(self):
         headers = {
@@ -149,45 +242,121 @@ class _SSEThread(Thread):
             "Accept": "text/event-stream; charset=utf-8",
         }
         self._http_stream = requests.get(self._url, stream=True, headers=headers, timeout=30)
-        self._client = sseclient.SSEClient(self._http_stream)
 
-        for event in self._client.events():
-            if event.event == "order":
-                self._on_order_event(json.loads(event.data))
-            elif event.event == "trade":
-                data = json.loads(event.data)
+        for event, payload in _iter_sse_frames(self._http_stream):
+            if event == b"order":
+                self._on_order_event(orjson.loads(payload))
+            elif event == b"trade":
+                data = orjson.loads(payload)
                 trades = data if isinstance(data, list) else [data]
-                trade_fields = {f.name for f in Trade.__dataclass_fields__.values()}
                 for t in trades:
-                    self._handle_trade_event(Trade(**{k: v for k, v in t.items() if k in trade_fields}))
+                    self._handle_trade_event(_trade_from_json(t))
 
     def _on_order_event(self, data: dict[str, Any]):
-        buy_orders = sorted(
-            [
-                Order(price=float(price), volume=v["marketVolume"], own_volume=v["userVolume"])
-                for price, v in data["buyOrders"].items()
-            ],
-            key=lambda o: -o.price,
-        )
-        sell_orders = sorted(
-            [
-                Order(price=float(price), volume=v["marketVolume"], own_volume=v["userVolume"])
-                for price, v in data["sellOrders"].items()
-            ],
-            key=lambda o: o.price,
+        product = data["productsymbol"]
+        sides = self._books.get(product)
+        if sides is None:
+            sides = self._books[product] = (_BookSide(descending=True), _BookSide(descending=False))
+        bids, asks = sides
+        self._handle_orderbook(
+            OrderBook(product, data["tickSize"], bids.apply(data["buyOrders"]), asks.apply(data["sellOrders"]))
         )
-        self._handle_orderbook(OrderBook(data["productsymbol"], data["tickSize"], buy_orders, sell_orders))
+
+
+class _TokenBucket:
+    """Thread-safe token bucket: up to burst calls at once, refilled at rate per second."""
+
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+class _PollThread(Thread):
+    """Background thread that calls a function every interval seconds until closed."""
+
+    def __init__(self, interval: float, poll: Callable[[], Any]):
+        super().__init__(daemon=True)
+        self._interval = interval
+        self._poll = poll
+        self._closed = Event()
+
+    def run(self):
+        while not self._closed.wait(self._interval):
+            try:
+                self._poll()
+            except Exception:
+                print("Poll error, retrying...")
+                print(format_exc())
+
+    def close(self):
+        self._closed.set()
 
 
 class BaseBot(ABC):
     """Base bot for CMI Exchange.
     """
 
-    def __init__(self, cmi_url: str, username: str, password: str):
+    def __init__(self, cmi_url: str, username: str, password: str, session: requests.Session | None = None):
         self._cmi_url = cmi_url.rstrip("/")
         self.username = username
         self._password = password
         self._sse_thread: _SSEThread | None = None
+        self._position_sync: _PollThread | None = None
+
+        # Endpoint URLs, built once rather than per request
+        self._url_trade = f"{self._cmi_url}/api/trade"
+        self._url_order = f"{self._cmi_url}/api/order"
+        self._url_cancel_bulk = f"{self._cmi_url}/api/order/cancel-bulk"
+        self._url_orders = f"{self._cmi_url}/api/order/current-user"
+        self._url_products = f"{self._cmi_url}/api/product"
+        self._url_orderbook_tmpl = self._cmi_url + "/api/product/{}/order-book/current-user"
+        self._url_positions = f"{self._cmi_url}/api/position/current-user"
+        self._url_pnl = f"{self._cmi_url}/api/profit/current-user"
+
+        # One pooled keep-alive session shared by every REST call. Any
+        # requests.Session-compatible transport can be injected instead.
+        # Never retry at the transport layer: a resent POST /api/order is a
+        # second order, so failures surface to the caller instead.
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_IN_FLIGHT, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self._session = session
+        self._session.headers.update(STANDARD_HEADERS)
+        # Flipped off the first time the exchange rejects the bulk-cancel route
+        self._bulk_cancel_supported = True
+        # Reused workers for fan-out calls instead of one fresh thread per request
+        self._executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT, thread_name_prefix="cmi-rest")
+        self._fan_out_limiter = _TokenBucket(FAN_OUT_RATE, FAN_OUT_RATE)
+
+        # Net positions mirrored locally from our own fills on the stream and
+        # reconciled against REST by every get_positions() call. The stream
+        # thread and REST callers both go through _positions_lock.
+        self._positions: dict[str, int] = {}
+        self._positions_lock = Lock()
+        # Monotonic time of the last stream fill applied per product
+        self._last_fill: dict[str, float] = {}
+        # (issue time, snapshot) of the previous REST positions read
+        self._last_sync: tuple[float, dict[str, int]] | None = None
+        # Bumped for every one of our fills seen on the stream
+        self.fill_count = 0
+        self.position_sync_interval = POSITION_SYNC_INTERVAL
 
         # Incremental trade state
         self.trades: list[Trade] = []
@@ -196,9 +365,8 @@ class BaseBot(ABC):
 
     @cached_property
     def auth_token(self) -> str:
-        response = requests.post(
+        response = self._session.post(
             f"{self._cmi_url}/api/user/authenticate",
-            headers=STANDARD_HEADERS,
             json={"username": self.username, "password": self._password},
         )
         if not response.ok:
@@ -219,11 +387,20 @@ class BaseBot(ABC):
             bearer=self.auth_token,
             url=f"{self._cmi_url}/api/market/stream",
             handle_orderbook=self.on_orderbook,
-            handle_trade_event=self.on_trades,
+            handle_trade_event=self._on_trade_event,
         )
+        # Fills were not mirrored while stopped, so the first read seeds from scratch
+        self._last_sync = None
+        self.get_positions()
+        self._position_sync = _PollThread(self.position_sync_interval, self.get_positions)
         self._sse_thread.start()
+        self._position_sync.start()
 
     def stop(self) -> None:
+        if self._position_sync:
+            self._position_sync.close()
+            self._position_sync.join(timeout=5)
+            self._position_sync = None
         if self._sse_thread:
             self._sse_thread.close()
             self._sse_thread.join(timeout=5)
@@ -245,25 +422,27 @@ class BaseBot(ABC):
         Uses incremental loading: only requests trades newer than the last
         seen timestamp. Returns the full accumulated list.
         """
+        self.get_new_market_trades()
+        return self.trades
+
+    def get_new_market_trades(self) -> list[Trade]:
+        """Like get_market_trades(), but return only the trades this call added."""
         params: dict[str, str] = {}
         if self._trade_watermark:
             params["from"] = self._trade_watermark
-        response = requests.get(
-            f"{self._cmi_url}/api/trade",
+        response = self._session.get(
+            self._url_trade,
             params=params,
-            headers=self._auth_headers(),
+            headers=self._auth_headers,
         )
         self._last_trade_fetch = time.monotonic()
         if not response.ok:
             print(f"Failed to fetch trades: {response.status_code}")
-            return self.trades
+            return []
 
         new_trades = []
-        trade_fields = {f for f in Trade.__dataclass_fields__}
         for raw in response.json():
-            # Filter to only fields that Trade expects
-            filtered = {k: v for k, v in raw.items() if k in trade_fields}
-            trade = Trade(**filtered)
+            trade = _trade_from_json(raw)
             if self._trade_watermark is None or trade.timestamp > self._trade_watermark:
                 new_trades.append(trade)
 
@@ -271,7 +450,7 @@ class BaseBot(ABC):
             self.trades.extend(new_trades)
             self._trade_watermark = new_trades[-1].timestamp
 
-        return self.trades
+        return new_trades
 
     @property
     def last_trade_fetch_age(self) -> float | None:
@@ -283,10 +462,12 @@ class BaseBot(ABC):
     # -- trading helpers --
 
     def send_order(self, order: OrderRequest) -> OrderResponse | None:
-        response = requests.post(
-            f"{self._cmi_url}/api/order",
-            json=asdict(order),
-            headers=self._auth_headers(),
+        # Hand-rolled body: asdict() deep-copies and json= goes through the stdlib encoder
+        body = {"product": order.product, "price": order.price, "side": order.side, "volume": order.volume}
+        response = self._session.post(
+            self._url_order,
+            data=orjson.dumps(body),
+            headers=self._auth_headers,
         )
         if response.ok:
             return OrderResponse(**response.json())
@@ -294,58 +475,180 @@ class BaseBot(ABC):
         return None
 
     def send_orders(self, orders: list[OrderRequest]) -> list[OrderResponse]:
-        results: list[OrderResponse] = []
+        return [r for r in self._fan_out(self.send_order, orders) if r]
 
-        def _send(o: OrderRequest):
-            r = self.send_order(o)
-            if r:
-                results.append(r)
+    def cancel_order(self, order_id: str) -> bool:
+        response = self._session.delete(f"{self._url_order}/{order_id}", headers=self._auth_headers)
+        if not response.ok:
+            print(f"Cancel failed for {order_id}: {response.status_code} - {response.text}")
+        return response.ok
 
-        threads = [Thread(target=_send, args=(o,)) for o in orders]
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
-        return results
+    def cancel_orders_bulk(self, order_ids: list[str]) -> None:
+        """Cancel several orders in one round trip, falling back to per-id cancels.
 
-    def cancel_order(self, order_id: str) -> None:
-        requests.delete(f"{self._cmi_url}/api/order/{order_id}", headers=self._auth_headers())
+        If the exchange says the bulk route does not exist (404/405/501) that
+        is remembered and later calls go straight to concurrent per-id DELETEs.
+        Any other failure, including transient 4xx like 429, falls back for
+        this call only.
+        """
+        if not order_ids:
+            return
+        if self._bulk_cancel_supported:
+            response = self._session.post(
+                self._url_cancel_bulk,
+                data=orjson.dumps({"ids": order_ids}),
+                headers=self._auth_headers,
+            )
+            if response.ok:
+                return
+            if response.status_code in (404, 405, 501):
+                self._bulk_cancel_supported = False
+            else:
+                print(f"Bulk cancel failed: {response.status_code} - {response.text}")
+        self._fan_out(self.cancel_order, order_ids)
 
     def cancel_all_orders(self) -> None:
-        orders = self.get_orders()
-        threads = [Thread(target=self.cancel_order, args=(o["id"],)) for o in orders]
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
+        self.cancel_orders_bulk([o["id"] for o in self.get_orders()])
+
+    def cancel_all_and_get_positions(self) -> tuple[dict[str, int], bool]:
+        """cancel_all_orders() then get_positions(), with the cancels confirmed in between.
+
+        Returns (positions, confirmed). confirmed is False when open orders
+        could not be read or some cancel was not seen to take effect within
+        wait_for_cancels()' timeout; the positions may then still move as
+        those orders fill, so callers must not size closes off them.
+        """
+        open_ids = self._open_order_ids()
+        if open_ids is None:
+            return self.get_positions(), False
+        self.cancel_orders_bulk(list(open_ids))
+        confirmed = self.wait_for_cancels(list(open_ids))
+        return self.get_positions(), confirmed
+
+    def wait_for_cancels(self, order_ids: list[str], timeout: float = 0.3) -> bool:
+        """Poll open orders with exponential backoff until none of order_ids remain.
+
+        Returns False if some were still open, or could not be confirmed gone
+        because the order poll kept failing, when timeout ran out.
+        """
+        pending = set(order_ids)
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while pending:
+            open_ids = self._open_order_ids()
+            if open_ids is not None:
+                pending &= open_ids
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay *= 2
+        return not pending
+
+    def _open_order_ids(self) -> set[str] | None:
+        # Unlike get_orders(), a failed read is None rather than an empty book
+        try:
+            response = self._session.get(self._url_orders, headers=self._auth_headers)
+        except requests.RequestException as e:
+            print(f"Order poll failed: {e}")
+            return None
+        if not response.ok:
+            print(f"Order poll failed: {response.status_code}")
+            return None
+        return {o["id"] for o in response.json()}
 
     def get_orders(self, product: str | None = None) -> list[dict]:
         params = {"productsymbol": product} if product else {}
-        response = requests.get(
-            f"{self._cmi_url}/api/order/current-user",
+        response = self._session.get(
+            self._url_orders,
             params=params,
-            headers=self._auth_headers(),
+            headers=self._auth_headers,
         )
         return response.json() if response.ok else []
 
     def get_products(self) -> list[Product]:
-        response = requests.get(f"{self._cmi_url}/api/product", headers=self._auth_headers())
+        response = self._session.get(self._url_products, headers=self._auth_headers)
         response.raise_for_status()
         return [Product(**p) for p in response.json()]
 
+    def get_products_cached(self, refresh: bool = False) -> list[Product]:
+        """Product list from a per-exchange disk cache, refetched once stale or on refresh."""
+        host = urlsplit(self._cmi_url).netloc.replace(":", "_")
+        path = PRODUCTS_CACHE_DIR / f"products_{host}.json"
+        if not refresh:
+            try:
+                if time.time() - path.stat().st_mtime < PRODUCTS_CACHE_TTL:
+                    return [Product(**p) for p in orjson.loads(path.read_bytes())]
+            except (OSError, orjson.JSONDecodeError, TypeError):
+                pass
+
+        products = self.get_products()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_bytes(orjson.dumps([asdict(p) for p in products]))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not cache products: {e}")
+        return products
+
     def get_positions(self) -> dict[str, int]:
-        response = requests.get(
-            f"{self._cmi_url}/api/position/current-user",
-            headers=self._auth_headers(),
+        issued = time.monotonic()
+        response = self._session.get(
+            self._url_positions,
+            headers=self._auth_headers,
         )
         if response.ok:
-            return {p["product"]: p["netPosition"] for p in response.json()}
+            positions = {p["product"]: p["netPosition"] for p in response.json()}
+            self._reconcile_positions(issued, positions)
+            return positions
         return {}
 
+    def _reconcile_positions(self, issued: float, snapshot: dict[str, int]) -> None:
+        """Fold a REST snapshot into the local mirror without dropping or double-applying fills.
+
+        A fill in flight around a snapshot may or may not be in it, and its
+        stream event may land either side of the response. So a product only
+        takes the REST value once it has had no stream fill since the previous
+        snapshot was requested and both snapshots agree; until it goes quiet
+        the stream-applied value stands.
+        """
+        with self._positions_lock:
+            last, self._last_sync = self._last_sync, (issued, snapshot)
+            positions = self._positions
+            if last is None or self._sse_thread is None:
+                # Seeding, or not streaming: REST is the only source
+                positions.clear()
+                positions.update(snapshot)
+                return
+            since = min(last[0], issued)
+            previous = last[1]
+            for product in positions.keys() | snapshot.keys():
+                if self._last_fill.get(product, float("-inf")) >= since:
+                    continue
+                rest = snapshot.get(product, 0)
+                if rest != previous.get(product, 0):
+                    continue
+                if product in snapshot:
+                    positions[product] = rest
+                else:
+                    positions.pop(product, None)
+
+    @property
+    def local_positions(self) -> dict[str, int]:
+        """Net positions mirrored from the stream, without a round trip.
+
+        Only kept current while the bot is running (see start()); drift from
+        missed or double-counted fills is corrected by the periodic REST sync.
+        Returns a copy, so it is safe to iterate while fills keep arriving.
+        """
+        with self._positions_lock:
+            return dict(self._positions)
+
     def get_orderbook(self, product: str) -> OrderBook:
-        response = requests.get(
-            f"{self._cmi_url}/api/product/{product}/order-book/current-user",
-            headers=self._auth_headers(),
+        response = self._session.get(
+            self._url_orderbook_tmpl.format(product),
+            headers=self._auth_headers,
         )
         response.raise_for_status()
         data = response.json()
@@ -360,16 +663,97 @@ class BaseBot(ABC):
         return OrderBook(data["product"], data["tickSize"], buy_orders, sell_orders)
 
     def get_pnl(self) -> dict:
-        response = requests.get(
-            f"{self._cmi_url}/api/profit/current-user",
-            headers=self._auth_headers(),
+        response = self._session.get(
+            self._url_pnl,
+            headers=self._auth_headers,
         )
         return response.json() if response.ok else {}
 
     # -- internals --
 
+    def _fan_out(self, call: Callable[[Any], Any], items: list) -> list:
+        """Run call over items concurrently on the shared pool, paced by the rate limiter.
+
+        Returns results in input order once every call has completed. A call
+        that raises is logged and yields None, so one failure cannot hide the
+        results of the others.
+        """
+        def paced(item):
+            self._fan_out_limiter.acquire()
+            try:
+                return call(item)
+            except Exception as e:
+                print(f"{getattr(call, '__name__', 'call')}({item!r}) failed: {e}")
+                return None
+
+        return list(self._executor.map(paced, items))
+
+    def _on_trade_event(self, trade: Trade) -> None:
+        if trade.buyer == self.username or trade.seller == self.username:
+            with self._positions_lock:
+                positions = self._positions
+                if trade.buyer == self.username:
+                    positions[trade.product] = positions.get(trade.product, 0) + trade.volume
+                if trade.seller == self.username:
+                    positions[trade.product] = positions.get(trade.product, 0) - trade.volume
+                self._last_fill[trade.product] = time.monotonic()
+                self.fill_count += 1
+        self.on_trades(trade)
+
+    @cached_property
     def _auth_headers(self) -> dict[str, str]:
-        return {**STANDARD_HEADERS, "Authorization": self.auth_token}
+        # The only place the token is attached: it is never written into the
+        # (possibly injected, shared) session. Content-Type lives on the
+        # session; built once so requests share one dict.
+        return {"Authorization": self.auth_token}
+
+
+ARB_NONE = 0
+ARB_ETF_OVERPRICED = 1
+ARB_ETF_UNDERPRICED = 2
+
+
+def check_spreads(
+    etf_bid: float,
+    etf_ask: float,
+    syn_bid: float,
+    syn_ask: float,
+    pos_1: int,
+    pos_3: int,
+    pos_5: int,
+    pos_7: int,
+    min_spread: float,
+    max_pos: int,
+    order_size: int,
+) -> int:
+    """Arbitrage decision kernel: pure scalar math, no I/O or object access.
+
+    Returns ARB_ETF_OVERPRICED (buy components, sell ETF), ARB_ETF_UNDERPRICED
+    (buy ETF, sell components) or ARB_NONE.
+    """
+    # |pos + order_size| <= max_pos  <=>  buy_lo <= pos <= buy_hi, likewise for sells
+    buy_lo, buy_hi = -max_pos - order_size, max_pos - order_size
+    sell_lo, sell_hi = order_size - max_pos, max_pos + order_size
+
+    # Opportunity 1: ETF is overpriced
+    # Buy components (at syn_ask), sell ETF (at etf_bid)
+    if etf_bid - syn_ask > min_spread:
+        if (buy_lo <= pos_1 <= buy_hi and
+            buy_lo <= pos_3 <= buy_hi and
+            buy_lo <= pos_5 <= buy_hi and
+            sell_lo <= pos_7 <= sell_hi):
+            return ARB_ETF_OVERPRICED
+
+    # Opportunity 2: ETF is underpriced
+    # Buy ETF (at etf_ask), sell components (at syn_bid)
+    elif syn_bid - etf_ask > min_spread:
+        if (sell_lo <= pos_1 <= sell_hi and
+            sell_lo <= pos_3 <= sell_hi and
+            sell_lo <= pos_5 <= sell_hi and
+            buy_lo <= pos_7 <= buy_hi):
+            return ARB_ETF_UNDERPRICED
+
+    return ARB_NONE
 
 
 class ETFArbitrageBot(BaseBot):
@@ -378,11 +762,19 @@ class ETFArbitrageBot(BaseBot):
     ETF (Market 7) = Market 1 (Water) + Market 3 (Weather) + Market 5 (Airport arrivals)
     """
 
-    def __init__(self, cmi_url: str, username: str, password: str):
-        super().__init__(cmi_url, username, password)
+    def __init__(self, cmi_url: str, username: str, password: str, session: requests.Session | None = None):
+        super().__init__(cmi_url, username, password, session)
 
         # Track orderbooks for all relevant markets
         self.orderbooks: dict[str, OrderBook] = {}
+        # Top-of-book columns, refreshed once per update so lookups skip the book walk
+        self._best_bids: dict[str, float | None] = {}
+        self._best_asks: dict[str, float | None] = {}
+        # Immutable (MARKET_1, MARKET_3, MARKET_5, MARKET_7) view, swapped in whole on each update
+        self._book_snapshot: tuple[OrderBook, OrderBook, OrderBook, OrderBook] | None = None
+        # Component sums, recomputed only when MARKET_1/3/5 update
+        self._synthetic_bid: float | None = None
+        self._synthetic_ask: float | None = None
 
         # Configuration - actual product symbols from the exchange
         self.MARKET_1 = "TIDE_SPOT"  # Water level (abs tidal height in mm)
@@ -401,10 +793,21 @@ class ETFArbitrageBot(BaseBot):
     def on_orderbook(self, orderbook: OrderBook) -> None:
         """Store orderbook updates and check for arbitrage opportunities."""
         self.orderbooks[orderbook.product] = orderbook
+        self._best_bids[orderbook.product] = orderbook.best_bid
+        self._best_asks[orderbook.product] = orderbook.best_ask
+        if orderbook.product in (self.MARKET_1, self.MARKET_3, self.MARKET_5):
+            self._synthetic_bid = self._sum_components(self._best_bids)
+            self._synthetic_ask = self._sum_components(self._best_asks)
 
         # Check for arbitrage when we have all orderbooks
-        if all(m in self.orderbooks for m in [self.MARKET_1, self.MARKET_3, self.MARKET_5, self.MARKET_7]):
-            self.check_arbitrage()
+        books = self.orderbooks
+        try:
+            snapshot = (books[self.MARKET_1], books[self.MARKET_3], books[self.MARKET_5], books[self.MARKET_7])
+        except KeyError:
+            return
+        # A single reference assignment, so readers never see a half-updated view
+        self._book_snapshot = snapshot
+        self.check_arbitrage()
 
     def on_trades(self, trade: Trade) -> None:
         """Handle trade events."""
@@ -412,17 +815,11 @@ class ETFArbitrageBot(BaseBot):
 
     def get_best_bid(self, product: str) -> float | None:
         """Get best bid price for a product."""
-        if product not in self.orderbooks:
-            return None
-        book = self.orderbooks[product]
-        return book.buy_orders[0].price if book.buy_orders else None
+        return self._best_bids.get(product)
 
     def get_best_ask(self, product: str) -> float | None:
         """Get best ask price for a product."""
-        if product not in self.orderbooks:
-            return None
-        book = self.orderbooks[product]
-        return book.sell_orders[0].price if book.sell_orders else None
+        return self._best_asks.get(product)
 
     def get_mid_price(self, product: str) -> float | None:
         """Get mid price for a product."""
@@ -433,26 +830,22 @@ class ETFArbitrageBot(BaseBot):
         return (bid + ask) / 2
 
     def get_synthetic_etf_bid(self) -> float | None:
-        """Calculate the synthetic ETF bid (what we can sell components for)."""
-        # To create ETF, we buy components, so we use best bid prices (what we can sell for)
-        bid_1 = self.get_best_bid(self.MARKET_1)
-        bid_3 = self.get_best_bid(self.MARKET_3)
-        bid_5 = self.get_best_bid(self.MARKET_5)
-
-        if None in [bid_1, bid_3, bid_5]:
-            return None
-        return bid_1 + bid_3 + bid_5
+        """Synthetic ETF bid (what we can sell components for)."""
+        return self._synthetic_bid
 
     def get_synthetic_etf_ask(self) -> float | None:
-        """Calculate the synthetic ETF ask (what we must pay for components)."""
-        # To create ETF, we buy components, so we use best ask prices (what we must pay)
-        ask_1 = self.get_best_ask(self.MARKET_1)
-        ask_3 = self.get_best_ask(self.MARKET_3)
-        ask_5 = self.get_best_ask(self.MARKET_5)
-
-        if None in [ask_1, ask_3, ask_5]:
-            return None
-        return ask_1 + ask_3 + ask_5
+        """Synthetic ETF ask (what we must pay for components)."""
+        return self._synthetic_ask
+
+    def _sum_components(self, prices: dict[str, float | None]) -> float | None:
+        """Sum the MARKET_1/3/5 prices, or None as soon as one side is missing."""
+        total = 0
+        for market in (self.MARKET_1, self.MARKET_3, self.MARKET_5):
+            price = prices.get(market)
+            if price is None:
+                return None
+            total += price
+        return total
 
     def check_arbitrage(self) -> None:
         """Check for arbitrage opportunities between ETF and its components."""
@@ -462,103 +855,120 @@ class ETFArbitrageBot(BaseBot):
             if current_time - self._last_trade_time < self._min_trade_interval:
                 return
 
-            positions = self.get_positions()
+            # Read the snapshot once so every price below comes from the same view
+            snapshot = self._book_snapshot
+            if snapshot is None:
+                return
+            book_7 = snapshot[3]
 
             # Get ETF prices
-            etf_bid = self.get_best_bid(self.MARKET_7)
-            etf_ask = self.get_best_ask(self.MARKET_7)
+            etf_bid = book_7.best_bid
+            etf_ask = book_7.best_ask
 
-            # Get synthetic ETF prices
-            synthetic_bid = self.get_synthetic_etf_bid()
-            synthetic_ask = self.get_synthetic_etf_ask()
+            # Synthetic ETF prices are kept current by on_orderbook, which
+            # publishes them together with the snapshot before we run
+            synthetic_bid = self._synthetic_bid
+            synthetic_ask = self._synthetic_ask
 
-            if None in [etf_bid, etf_ask, synthetic_bid, synthetic_ask]:
+            if etf_bid is None or etf_ask is None or synthetic_bid is None or synthetic_ask is None:
                 return
 
-            # Opportunity 1: ETF is overpriced
-            # Buy components (at synthetic_ask), sell ETF (at etf_bid)
-            spread_1 = etf_bid - synthetic_ask
-
-            # Opportunity 2: ETF is underpriced
-            # Buy ETF (at etf_ask), sell components (at synthetic_bid)
-            spread_2 = synthetic_bid - etf_ask
-
-            # Check position limits
-            pos_1 = positions.get(self.MARKET_1, 0)
-            pos_3 = positions.get(self.MARKET_3, 0)
-            pos_5 = positions.get(self.MARKET_5, 0)
-            pos_7 = positions.get(self.MARKET_7, 0)
-
-            # Execute arbitrage if spread is sufficient
-            if spread_1 > self.MIN_SPREAD:
-                # ETF overpriced: buy components, sell ETF
-                if (abs(pos_1 + self.ORDER_SIZE) <= self.MAX_POSITION and
-                    abs(pos_3 + self.ORDER_SIZE) <= self.MAX_POSITION and
-                    abs(pos_5 + self.ORDER_SIZE) <= self.MAX_POSITION and
-                    abs(pos_7 - self.ORDER_SIZE) <= self.MAX_POSITION):
-
-                    print(f"Arbitrage: ETF overpriced by {spread_1:.2f}. Buying components, selling ETF.")
-                    self.execute_arbitrage_etf_overpriced()
-                    self._last_trade_time = time.monotonic()
-
-            elif spread_2 > self.MIN_SPREAD:
-                # ETF underpriced: buy ETF, sell components
-                if (abs(pos_1 - self.ORDER_SIZE) <= self.MAX_POSITION and
-                    abs(pos_3 - self.ORDER_SIZE) <= self.MAX_POSITION and
-                    abs(pos_5 - self.ORDER_SIZE) <= self.MAX_POSITION and
-                    abs(pos_7 + self.ORDER_SIZE) <= self.MAX_POSITION):
-
-                    print(f"Arbitrage: ETF underpriced by {spread_2:.2f}. Buying ETF, selling components.")
-                    self.execute_arbitrage_etf_underpriced()
-                    self._last_trade_time = time.monotonic()
+            # Local mirror instead of a blocking REST round trip per update
+            positions = self.local_positions
+
+            signal = check_spreads(
+                etf_bid,
+                etf_ask,
+                synthetic_bid,
+                synthetic_ask,
+                positions.get(self.MARKET_1, 0),
+                positions.get(self.MARKET_3, 0),
+                positions.get(self.MARKET_5, 0),
+                positions.get(self.MARKET_7, 0),
+                self.MIN_SPREAD,
+                self.MAX_POSITION,
+                self.ORDER_SIZE,
+            )
+
+            if signal == ARB_ETF_OVERPRICED:
+                print(f"Arbitrage: ETF overpriced by {etf_bid - synthetic_ask:.2f}. Buying components, selling ETF.")
+                self.execute_arbitrage_etf_overpriced(snapshot)
+                self._last_trade_time = time.monotonic()
+
+            elif signal == ARB_ETF_UNDERPRICED:
+                print(f"Arbitrage: ETF underpriced by {synthetic_bid - etf_ask:.2f}. Buying ETF, selling components.")
+                self.execute_arbitrage_etf_underpriced(snapshot)
+                self._last_trade_time = time.monotonic()
 
         except Exception as e:
             print(f"Error in check_arbitrage: {e}")
 
-    def execute_arbitrage_etf_overpriced(self) -> None:
-        """Execute arbitrage when ETF is overpriced: buy components, sell ETF."""
-        orders = []
+    def execute_arbitrage_etf_overpriced(
+        self, snapshot: tuple[OrderBook, OrderBook, OrderBook, OrderBook] | None = None
+    ) -> None:
+        """Execute arbitrage when ETF is overpriced: buy components, sell ETF.
+
+        Prices come from the given snapshot (the view the opportunity was found in),
+        defaulting to the latest one.
+        """
+        snapshot = snapshot or self._book_snapshot
+        if snapshot is None:
+            return
+        book_1, book_3, book_5, book_7 = snapshot
 
         # Buy components at market (cross the spread)
-        ask_1 = self.get_best_ask(self.MARKET_1)
-        ask_3 = self.get_best_ask(self.MARKET_3)
-        ask_5 = self.get_best_ask(self.MARKET_5)
+        ask_1 = book_1.best_ask
+        ask_3 = book_3.best_ask
+        ask_5 = book_5.best_ask
 
         # Sell ETF at market
-        bid_7 = self.get_best_bid(self.MARKET_7)
+        bid_7 = book_7.best_bid
 
-        if None in [ask_1, ask_3, ask_5, bid_7]:
+        if None in (ask_1, ask_3, ask_5, bid_7):
             return
 
-        orders.append(OrderRequest(self.MARKET_1, ask_1, Side.BUY, self.ORDER_SIZE))
-        orders.append(OrderRequest(self.MARKET_3, ask_3, Side.BUY, self.ORDER_SIZE))
-        orders.append(OrderRequest(self.MARKET_5, ask_5, Side.BUY, self.ORDER_SIZE))
-        orders.append(OrderRequest(self.MARKET_7, bid_7, Side.SELL, self.ORDER_SIZE))
+        orders = [
+            OrderRequest(self.MARKET_1, ask_1, Side.BUY, self.ORDER_SIZE),
+            OrderRequest(self.MARKET_3, ask_3, Side.BUY, self.ORDER_SIZE),
+            OrderRequest(self.MARKET_5, ask_5, Side.BUY, self.ORDER_SIZE),
+            OrderRequest(self.MARKET_7, bid_7, Side.SELL, self.ORDER_SIZE),
+        ]
 
         print(f"  Sending orders: BUY {self.MARKET_1}@{ask_1}, BUY {self.MARKET_3}@{ask_3}, BUY {self.MARKET_5}@{ask_5}, SELL {self.MARKET_7}@{bid_7}")
         responses = self.send_orders(orders)
         for r in responses:
             print(f"    -> {r.side} {r.product} {r.filled}/{r.volume}@{r.price} (status={r.status})")
 
-    def execute_arbitrage_etf_underpriced(self) -> None:
-        """Execute arbitrage when ETF is underpriced: buy ETF, sell components."""
-        orders = []
+    def execute_arbitrage_etf_underpriced(
+        self, snapshot: tuple[OrderBook, OrderBook, OrderBook, OrderBook] | None = None
+    ) -> None:
+        """Execute arbitrage when ETF is underpriced: buy ETF, sell components.
+
+        Prices come from the given snapshot (the view the opportunity was found in),
+        defaulting to the latest one.
+        """
+        snapshot = snapshot or self._book_snapshot
+        if snapshot is None:
+            return
+        book_1, book_3, book_5, book_7 = snapshot
 
         # Buy ETF at market
-        ask_7 = self.get_best_ask(self.MARKET_7)
+        ask_7 = book_7.best_ask
 
         # Sell components at market
-        bid_1 = self.get_best_bid(self.MARKET_1)
-        bid_3 = self.get_best_bid(self.MARKET_3)
-        bid_5 = self.get_best_bid(self.MARKET_5)
+        bid_1 = book_1.best_bid
+        bid_3 = book_3.best_bid
+        bid_5 = book_5.best_bid
 
-        if None in [ask_7, bid_1, bid_3, bid_5]:
+        if None in (ask_7, bid_1, bid_3, bid_5):
             return
 
-        orders.append(OrderRequest(self.MARKET_7, ask_7, Side.BUY, self.ORDER_SIZE))
-        orders.append(OrderRequest(self.MARKET_1, bid_1, Side.SELL, self.ORDER_SIZE))
-        orders.append(OrderRequest(self.MARKET_3, bid_3, Side.SELL, self.ORDER_SIZE))
-        orders.append(OrderRequest(self.MARKET_5, bid_5, Side.SELL, self.ORDER_SIZE))
+        orders = [
+            OrderRequest(self.MARKET_7, ask_7, Side.BUY, self.ORDER_SIZE),
+            OrderRequest(self.MARKET_1, bid_1, Side.SELL, self.ORDER_SIZE),
+            OrderRequest(self.MARKET_3, bid_3, Side.SELL, self.ORDER_SIZE),
+            OrderRequest(self.MARKET_5, bid_5, Side.SELL, self.ORDER_SIZE),
+        ]
 
         print(f"  Sending orders: BUY {self.MARKET_7}@{ask_7}, SELL {self.MARKET_1}@{bid_1}, SELL {self.MARKET_3}@{bid_3}, SELL {self.MARKET_5}@{bid_5}")
         responses = self.send_orders(orders)
@@ -5,6 +5,7 @@ Keeps retrying until all positions are 0.
 """
 
 import time
+from threading import Event
 from bot import BaseBot, OrderBook, Trade, OrderRequest, Side
 
 TEST_URL = "http://ec2-52-49-69-152.eu-west-1.compute.amazonaws.com/"
@@ -13,27 +14,37 @@ PASSWORD = "imsocooked"
 
 
 class PositionCloser(BaseBot):
+    def __init__(self, cmi_url: str, username: str, password: str):
+        super().__init__(cmi_url, username, password)
+        # Set whenever one of our fills arrives on the stream
+        self.fill_event = Event()
+
     def on_orderbook(self, orderbook: OrderBook) -> None:
         pass
 
     def on_trades(self, trade: Trade) -> None:
-        pass
+        if trade.buyer == self.username or trade.seller == self.username:
+            self.fill_event.set()
 
 
 print(f"\nConnecting to exchange as {USERNAME}...")
 bot = PositionCloser(TEST_URL, USERNAME, PASSWORD)
+bot.start()
 
 print("\n" + "="*60)
 print("EMERGENCY CLOSE - Closing ALL positions at market price")
 print("="*60)
 
 while True:
-    # Cancel all orders first
-    bot.cancel_all_orders()
-    time.sleep(0.3)
-
-    # Get fresh positions
-    positions = bot.get_positions()
+    # Cancel all orders first and get fresh positions
+    bot.fill_event.clear()
+    positions, confirmed = bot.cancel_all_and_get_positions()
+    if not confirmed:
+        # An old order may still be resting; closing the full size now could
+        # overshoot through zero if it fills, so wait and re-check instead
+        print("\n  Cancels not confirmed yet - waiting before sending closes")
+        time.sleep(0.3)
+        continue
     open_positions = {p: pos for p, pos in positions.items() if pos != 0}
 
     if not open_positions:
@@ -74,18 +85,18 @@ while True:
                 else:
                     print(f"  {product}: No asks - cannot buy")
 
-            time.sleep(0.3)
-
         except Exception as e:
             print(f"  {product}: Error - {e}")
 
-    time.sleep(1)
+    # Retry as soon as a fill lands, or after a second if the book is quiet
+    bot.fill_event.wait(timeout=1)
 
 # Final state
 print("\n--- Final State ---")
-bot.cancel_all_orders()
-
-positions = bot.get_positions()
+bot.stop()
+positions, confirmed = bot.cancel_all_and_get_positions()
+if not confirmed:
+    print("Some cancels were not confirmed - positions below may still move")
 open_pos = {p: pos for p, pos in positions.items() if pos != 0}
 if open_pos:
     print("Remaining positions:")
@@ -106,6 +117,7 @@ Keeps retrying until all positions are 0.
 """
 
 import time
+from threading import Event
 from bot import BaseBot, OrderBook, Trade, OrderRequest, Side
 
 TEST_URL = "http://ec2-52-49-69-152.eu-west-1.compute.amazonaws.com/"
@@ -114,27 +126,37 @@ PASSWORD = "imsocooked"
 
 
 class PositionCloser(BaseBot):
+    def __init__(self, cmi_url: str, username: str, password: str):
+        super().__init__(cmi_url, username, password)
+        # Set whenever one of our fills arrives on the stream
+        self.fill_event = Event()
+
     def on_orderbook(self, orderbook: OrderBook) -> None:
         pass
 
     def on_trades(self, trade: Trade) -> None:
-        pass
+        if trade.buyer == self.username or trade.seller == self.username:
+            self.fill_event.set()
 
 
 print(f"\nConnecting to exchange as {USERNAME}...")
 bot = PositionCloser(TEST_URL, USERNAME, PASSWORD)
+bot.start()
 
 print("\n" + "="*60)
 print("EMERGENCY CLOSE - Closing ALL positions at market price")
 print("="*60)
 
 while True:
-    # Cancel all orders first
-    bot.cancel_all_orders()
-    time.sleep(0.3)
-
-    # Get fresh positions
-    positions = bot.get_positions()
+    # Cancel all orders first and get fresh positions
+    bot.fill_event.clear()
+    positions, confirmed = bot.cancel_all_and_get_positions()
+    if not confirmed:
+        # An old order may still be resting; closing the full size now could
+        # overshoot through zero if it fills, so wait and re-check instead
+        print("\n  Cancels not confirmed yet - waiting before sending closes")
+        time.sleep(0.3)
+        continue
     open_positions = {p: pos for p, pos in positions.items() if pos != 0}
 
     if not open_positions:
@@ -175,18 +197,18 @@ while True:
                 else:
                     print(f"  {product}: No asks - cannot buy")
 
-            time.sleep(0.3)
-
         except Exception as e:
             print(f"  {product}: Error - {e}")
 
-    time.sleep(1)
+    # Retry as soon as a fill lands, or after a second if the book is quiet
+    bot.fill_event.wait(timeout=1)
 
 # Final state
 print("\n--- Final State ---")
-bot.cancel_all_orders()
-
-positions = bot.get_positions()
+bot.stop()
+positions, confirmed = bot.cancel_all_and_get_positions()
+if not confirmed:
+    print("Some cancels were not confirmed - positions below may still move")
 open_pos = {p: pos for p, pos in positions.items() if pos != 0}
 if open_pos:
     print("Remaining positions:")
@@ -1,188 +1,366 @@
 """Script to close ALL positions at a profit.
 
 Keeps running until all positions are closed profitably.
-- Cancels unfilled orders each loop
+- Leaves partly filled closes resting, cancelling them once the book moves past
 - Retries until position is actually 0
 """
 
+import atexit
+import logging
+import queue
+import sys
 import time
-from bot import BaseBot, OrderBook, Trade, OrderRequest, Side
+from collections import Counter
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from threading import Event, Lock
+from typing import Literal
+from bot import BaseBot, OrderBook, OrderResponse, Trade, OrderRequest, Side
 
 TEST_URL = "http://ec2-52-49-69-152.eu-west-1.compute.amazonaws.com/"
 USERNAME = "test1"
 PASSWORD = "test1"
 
-CHECK_INTERVAL = 3  # seconds between checks
+CHECK_INTERVAL = 1.0  # max seconds between checks when nothing we hold is moving
+MIN_CHECK_INTERVAL = 0.2  # floor between checks so a busy book cannot spin the REST loop
+MIN_LIVE_SEC = 0.5  # how long a partly filled close rests before it may be cancelled
+
+# Log through a queue so the close loop never blocks on terminal output
+log = logging.getLogger("smart_close")
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
+def decide_close(
+    net_pos: int, entry_price: float | None, best_bid: float | None, best_ask: float | None
+) -> tuple[float, float] | None:
+    """Exit price and P&L for closing net_pos at the touch, or None if either price is missing.
+
+    Longs exit at the bid and shorts at the ask; the close is worth sending when the P&L is positive.
+    """
+    exit_price = best_bid if net_pos > 0 else best_ask
+    if not entry_price or not exit_price:
+        return None
+    return exit_price, (exit_price - entry_price) * net_pos
+
+
+def _fill_key(trade: Trade) -> tuple:
+    """Identity of a fill, with the timestamp parsed so stream and REST formatting can differ."""
+    try:
+        ts = datetime.fromisoformat(trade.timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        ts = trade.timestamp
+    return ts, trade.product, trade.buyer, trade.seller, trade.price, trade.volume
+
+
+@dataclass(slots=True)
+class PosAgg:
+    """Running cost/quantity totals of our own fills in one product, updated in place."""
+    long_cost: float = 0
+    long_qty: int = 0
+    short_cost: float = 0
+    short_qty: int = 0
+
+    @property
+    def long_avg(self) -> float | None:
+        return self.long_cost / self.long_qty if self.long_qty > 0 else None
+
+    @property
+    def short_avg(self) -> float | None:
+        return self.short_cost / self.short_qty if self.short_qty > 0 else None
 
 
 class PositionCloser(BaseBot):
+    def __init__(self, cmi_url: str, username: str, password: str):
+        super().__init__(cmi_url, username, password)
+        self._books: dict[str, OrderBook] = {}
+        # Products whose book updates should wake the close loop
+        self.watched: set[str] = set()
+        self._tick = Event()
+        # Resting closes by order id, with the time they were sent
+        self._open: dict[str, tuple[float, OrderResponse]] = {}
+        # Set when a close fills, so the REST trade refresh runs once per pass at most
+        self._dirty = False
+        # Print order for the open products, re-sorted only when the set changes
+        self._sorted_products: list[str] = []
+
+        # Running per-product totals of our own fills, fed incrementally from
+        # both the stream and REST history
+        self._pos_acc: dict[str, PosAgg] = {}
+        # How many times each fill has arrived from each source, see update_entry_prices()
+        self._fill_counts: dict[str, Counter] = {"stream": Counter(), "rest": Counter()}
+        self._acc_lock = Lock()
+
     def on_orderbook(self, orderbook: OrderBook) -> None:
-        pass
+        self._books[orderbook.product] = orderbook
+        if orderbook.product in self.watched:
+            self._tick.set()
+
+    def wait_for_tick(self, timeout: float) -> None:
+        """Block until a watched book moves or one of our fills lands, or timeout passes."""
+        self._tick.wait(timeout)
+        self._tick.clear()
+
+    def track_open(self, responses: list[OrderResponse]) -> None:
+        """Note whether any close filled, and remember those that only partly did so they can rest."""
+        now = time.monotonic()
+        for resp in responses:
+            if resp.filled:
+                self._dirty = True
+            if resp.filled < resp.volume:
+                self._open[resp.id] = (now, resp)
+
+    def refresh_entry_prices(self) -> None:
+        """Pull trades since the last refresh, but only if a close filled in between.
+
+        No settle wait: our fills already reach the totals from the stream, and
+        this REST pass only backs that up (late copies are deduped per source).
+        """
+        if not self._dirty:
+            return
+        self._dirty = False
+        self.update_entry_prices(self.get_new_market_trades(), "rest")
+
+    def has_open_order(self, product: str) -> bool:
+        return any(resp.product == product for _, resp in self._open.values())
+
+    def cancel_stale_orders(self) -> list[str]:
+        """Cancel resting closes that have had MIN_LIVE_SEC to fill and that the book has moved past.
+
+        Ids stay tracked until the exchange confirms them gone, so a failed or
+        slow cancel is retried next pass rather than a second close being sent.
+        Returns the ids still unconfirmed.
+        """
+        now = time.monotonic()
+        stale = [
+            order_id for order_id, (sent, resp) in self._open.items()
+            if now - sent > MIN_LIVE_SEC and self._moved_past(resp)
+        ]
+        if not stale:
+            return []
+        try:
+            self.cancel_orders_bulk(stale)
+            confirmed = self.wait_for_cancels(stale)
+        except Exception as e:
+            log.warning("  Error cancelling resting closes - %s", e)
+            return stale
+        if not confirmed:
+            return stale
+        for order_id in stale:
+            del self._open[order_id]
+        return []
+
+    def forget_filled(self, open_positions: dict[str, int]) -> None:
+        """Drop resting closes for products that are now flat; they filled."""
+        for order_id, (_, resp) in list(self._open.items()):
+            if resp.product not in open_positions:
+                del self._open[order_id]
+
+    def _moved_past(self, resp: OrderResponse) -> bool:
+        # A resting close is stale once someone quotes inside it
+        book = self._books.get(resp.product)
+        if book is None:
+            return True
+        if resp.side == Side.SELL:
+            return book.best_ask is not None and book.best_ask < resp.price
+        return book.best_bid is not None and book.best_bid > resp.price
+
+    def sorted_products(self, open_positions: dict[str, int]) -> list[str]:
+        """Open products in a stable order, cached until a position opens or goes flat."""
+        if len(self._sorted_products) != len(open_positions) or not all(
+            p in open_positions for p in self._sorted_products
+        ):
+            self._sorted_products = sorted(open_positions)
+        return self._sorted_products
+
+    def prefetch_books(self, products: list[str]) -> None:
+        """Seed books the stream has not delivered yet, fetching them concurrently."""
+        missing = [p for p in products if p not in self._books]
+        for book in self._fan_out(self.get_orderbook, missing):
+            if book is not None:
+                self._books.setdefault(book.product, book)
+
+    def get_book(self, product: str) -> OrderBook:
+        """Latest streamed book, seeded over REST the first time a product is seen."""
+        book = self._books.get(product)
+        if book is None:
+            book = self._books[product] = self.get_orderbook(product)
+        return book
 
     def on_trades(self, trade: Trade) -> None:
-        pass
-
-
-def calculate_entry_prices(trades: list[Trade], username: str) -> dict:
-    """Calculate average entry price for longs and shorts separately."""
-    positions = {}
-
-    for trade in trades:
-        product = trade.product
-        if product not in positions:
-            positions[product] = {
-                'long_cost': 0,
-                'long_qty': 0,
-                'short_cost': 0,
-                'short_qty': 0,
-            }
-
-        if trade.buyer == username:
-            positions[product]['long_cost'] += trade.price * trade.volume
-            positions[product]['long_qty'] += trade.volume
-        elif trade.seller == username:
-            positions[product]['short_cost'] += trade.price * trade.volume
-            positions[product]['short_qty'] += trade.volume
-
-    result = {}
-    for product, data in positions.items():
-        result[product] = {
-            'long_avg': data['long_cost'] / data['long_qty'] if data['long_qty'] > 0 else None,
-            'long_qty': data['long_qty'],
-            'short_avg': data['short_cost'] / data['short_qty'] if data['short_qty'] > 0 else None,
-            'short_qty': data['short_qty'],
-        }
-
-    return result
-
-
-print(f"\nConnecting to exchange as {USERNAME}...")
+        self.update_entry_prices((trade,), "stream")
+        if trade.buyer == self.username or trade.seller == self.username:
+            self._tick.set()
+
+    def update_entry_prices(self, trades: Iterable[Trade], source: Literal["stream", "rest"]) -> None:
+        """Fold our own fills from one source into the running totals.
+
+        The stream and REST history overlap, and REST never repeats a trade
+        thanks to its watermark. Each source counts the fills it has delivered
+        and a fill is applied only once its count passes the other source's,
+        so each distinct fill ends up counted max(stream, rest) times: the
+        overlap is dropped but genuinely identical fills are kept.
+        """
+        username = self.username
+        pos_acc = self._pos_acc
+        mine = self._fill_counts[source]
+        other = self._fill_counts["rest" if source == "stream" else "stream"]
+        with self._acc_lock:
+            for trade in trades:
+                if trade.buyer != username and trade.seller != username:
+                    continue
+                key = _fill_key(trade)
+                mine[key] += 1
+                if mine[key] <= other[key]:
+                    continue
+
+                acc = pos_acc.get(trade.product)
+                if acc is None:
+                    acc = pos_acc[trade.product] = PosAgg()
+                if trade.buyer == username:
+                    acc.long_cost += trade.price * trade.volume
+                    acc.long_qty += trade.volume
+                else:
+                    acc.short_cost += trade.price * trade.volume
+                    acc.short_qty += trade.volume
+
+    def entry_prices(self, product: str) -> PosAgg | None:
+        """Fill totals for a product, with long_avg/short_avg computed on read."""
+        return self._pos_acc.get(product)
+
+
+log.info("\nConnecting to exchange as %s...", USERNAME)
 bot = PositionCloser(TEST_URL, USERNAME, PASSWORD)
+bot.start()
 
 # Fetch trade history once at start
-print("Fetching trade history...")
+log.info("Fetching trade history...")
 trades = bot.get_market_trades()
 my_trades = [t for t in trades if t.buyer == USERNAME or t.seller == USERNAME]
-print(f"Found {len(my_trades)} of your trades")
+log.info("Found %d of your trades", len(my_trades))
 
-entry_data = calculate_entry_prices(my_trades, USERNAME)
+bot.update_entry_prices(my_trades, "rest")
 
-print("\n" + "="*60)
-print("RUNNING - Will close positions when profitable")
-print("Press Ctrl+C to stop")
-print("="*60)
+log.info("\n" + "="*60)
+log.info("RUNNING - Will close positions when profitable")
+log.info("Press Ctrl+C to stop")
+log.info("="*60)
+
+# Clear out anything left resting from earlier runs - this frees up positions for closing
+bot.cancel_all_orders()
 
 try:
     while True:
-        # ALWAYS cancel all orders first - this frees up positions for closing
-        bot.cancel_all_orders()
-        time.sleep(0.3)
+        # Cancel closes that have rested long enough and been overtaken by the book
+        unconfirmed = bot.cancel_stale_orders()
+        if unconfirmed:
+            log.warning("  %d cancel(s) unconfirmed, still tracked and retried next pass", len(unconfirmed))
 
         # Get FRESH positions after cancelling orders
         positions = bot.get_positions()
 
         # Filter to non-zero positions
         open_positions = {p: pos for p, pos in positions.items() if pos != 0}
+        bot.forget_filled(open_positions)
 
         if not open_positions:
-            print("\n*** ALL POSITIONS CLOSED! ***")
+            log.info("\n*** ALL POSITIONS CLOSED! ***")
             break
 
-        print(f"\n--- {time.strftime('%H:%M:%S')} - {len(open_positions)} open positions ---")
-
-        for product, net_pos in sorted(open_positions.items()):
+        bot.watched = set(open_positions)
+        products = bot.sorted_products(open_positions)
+        log.info("\n--- %s - %d open positions ---", time.strftime('%H:%M:%S'), len(open_positions))
+
+        try:
+            bot.prefetch_books(products)
+        except Exception as e:
+            log.warning("  Error prefetching books - %s", e)
+
+        closes: list[OrderRequest] = []
+        for product in products:
+            net_pos = open_positions[product]
+            if bot.has_open_order(product):
+                log.info("  %s: %+d - close resting on the book", product, net_pos)
+                continue
             try:
-                ob = bot.get_orderbook(product)
-                data = entry_data.get(product, {})
+                ob = bot.get_book(product)
+                agg = bot.entry_prices(product)
 
+                qty = abs(net_pos)
                 if net_pos > 0:
                     # LONG position - need to sell at bid
-                    entry_price = data.get('long_avg')
-                    exit_price = ob.buy_orders[0].price if ob.buy_orders else None
-
-                    if entry_price and exit_price:
-                        pnl = (exit_price - entry_price) * net_pos
-                        profitable = exit_price > entry_price
-
-                        if profitable:
-                            # CLOSE IT!
-                            order = OrderRequest(product, exit_price, Side.SELL, abs(net_pos))
-                            print(f"  {product}: LONG {net_pos} - CLOSING at {exit_price} (entry={entry_price:.1f}, P&L={pnl:+.0f})")
-                            resp = bot.send_order(order)
-                            if resp:
-                                print(f"    -> filled={resp.filled}/{resp.volume}")
-                                # If not fully filled, cancel the remainder
-                                if resp.filled < resp.volume:
-                                    bot.cancel_order(resp.id)
-                                    print(f"    -> cancelled unfilled portion")
-
-                            # Refresh entry data
-                            time.sleep(0.3)
-                            trades = bot.get_market_trades()
-                            my_trades = [t for t in trades if t.buyer == USERNAME or t.seller == USERNAME]
-                            entry_data = calculate_entry_prices(my_trades, USERNAME)
-                        else:
-                            print(f"  {product}: LONG {net_pos} @ {entry_price:.1f}, current={exit_price}, P&L={pnl:+.0f} (waiting...)")
-                    else:
-                        print(f"  {product}: LONG {net_pos} - no entry/exit data")
-
+                    label, side = 'LONG', Side.SELL
+                    entry_price = agg.long_avg if agg else None
                 else:
                     # SHORT position - need to buy at ask
-                    entry_price = data.get('short_avg')
-                    exit_price = ob.sell_orders[0].price if ob.sell_orders else None
-
-                    if entry_price and exit_price:
-                        pnl = (entry_price - exit_price) * abs(net_pos)
-                        profitable = exit_price < entry_price
-
-                        if profitable:
-                            # CLOSE IT!
-                            order = OrderRequest(product, exit_price, Side.BUY, abs(net_pos))
-                            print(f"  {product}: SHORT {abs(net_pos)} - CLOSING at {exit_price} (entry={entry_price:.1f}, P&L={pnl:+.0f})")
-                            resp = bot.send_order(order)
-                            if resp:
-                                print(f"    -> filled={resp.filled}/{resp.volume}")
-                                # If not fully filled, cancel the remainder
-                                if resp.filled < resp.volume:
-                                    bot.cancel_order(resp.id)
-                                    print(f"    -> cancelled unfilled portion")
-
-                            # Refresh entry data
-                            time.sleep(0.3)
-                            trades = bot.get_market_trades()
-                            my_trades = [t for t in trades if t.buyer == USERNAME or t.seller == USERNAME]
-                            entry_data = calculate_entry_prices(my_trades, USERNAME)
-                        else:
-                            print(f"  {product}: SHORT {abs(net_pos)} @ {entry_price:.1f}, current={exit_price}, P&L={pnl:+.0f} (waiting...)")
+                    label, side = 'SHORT', Side.BUY
+                    entry_price = agg.short_avg if agg else None
+
+                decision = decide_close(net_pos, entry_price, *ob.top())
+
+                if decision:
+                    exit_price, pnl = decision
+
+                    if pnl > 0:
+                        # CLOSE IT! (sent with the rest of this pass's closes)
+                        closes.append(OrderRequest(product, exit_price, side, qty))
+                        log.info("  %s: %s %d - CLOSING at %s (entry=%.1f, P&L=%+.0f)", product, label, qty, exit_price, entry_price, pnl)
                     else:
-                        print(f"  {product}: SHORT {abs(net_pos)} - no entry/exit data")
+                        log.info("  %s: %s %d @ %.1f, current=%s, P&L=%+.0f (waiting...)", product, label, qty, entry_price, exit_price, pnl)
+                else:
+                    log.info("  %s: %s %d - no entry/exit data", product, label, qty)
+
+            except Exception as e:
+                log.warning("  %s: Error - %s", product, e)
 
+        if closes:
+            try:
+                # One concurrent submission for every close; failed sends are logged and left out
+                responses = bot.send_orders(closes)
             except Exception as e:
-                print(f"  {product}: Error - {e}")
+                log.warning("  Error sending closes - %s", e)
+                responses = []
+            # Leave partial fills resting; cancel_stale_orders() pulls them once the book moves on
+            bot.track_open(responses)
+            for resp in responses:
+                log.info("    -> %s: filled=%d/%d", resp.product, resp.filled, resp.volume)
 
-        time.sleep(CHECK_INTERVAL)
+        # Refresh entry data once for the whole pass
+        bot.refresh_entry_prices()
+
+        # Re-check as soon as something we hold moves, rather than on a fixed timer
+        time.sleep(MIN_CHECK_INTERVAL)
+        bot.wait_for_tick(CHECK_INTERVAL)
 
 except KeyboardInterrupt:
-    print("\n\nStopped by user.")
+    log.info("\n\nStopped by user.")
 
 # Final state
-print("\n--- Final State ---")
-bot.cancel_all_orders()
-
-positions = bot.get_positions()
+log.info("\n--- Final State ---")
+bot.stop()
+positions, confirmed = bot.cancel_all_and_get_positions()
+if not confirmed:
+    log.warning("Some cancels were not confirmed - positions below may still move")
 if positions:
     open_pos = {p: pos for p, pos in positions.items() if pos != 0}
     if open_pos:
-        print("Remaining positions:")
+        log.info("Remaining positions:")
         for product, pos in sorted(open_pos.items()):
-            print(f"  {product}: {pos:+d}")
+            log.info("  %s: %+d", product, pos)
     else:
-        print("Completely flat!")
+        log.info("Completely flat!")
 else:
-    print("Completely flat!")
+    log.info("Completely flat!")
 
 pnl = bot.get_pnl()
 if pnl:
-    print(f"\nTotal P&L: {pnl.get('totalProfit', 0)}")
+    log.info("\nTotal P&L: %s", pnl.get('totalProfit', 0))
 
-print("\nDone.")
+log.info("\nDone.")
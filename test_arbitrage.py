@@ -30,7 +30,7 @@ print(f"  {bot.MARKET_1} (Tide) + {bot.MARKET_3} (Weather) + {bot.MARKET_5} (Fli
 # First, show available products on the exchange
 print("\n--- Available Products ---")
 try:
-    products = bot.get_products()
+    products = bot.get_products_cached()
     for p in products:
         print(f"  {p.symbol} (tick={p.tickSize}, start={p.startingPrice})")
 except Exception as e:
@@ -41,6 +41,10 @@ bot.start()
 print("\n✓ Bot started. Listening for arbitrage opportunities...")
 print("Press Ctrl+C to stop.\n")
 
+pnl = None
+last_positions = None
+last_fill_count = None
+
 try:
     while True:
         time.sleep(5)
@@ -52,8 +56,7 @@ try:
         for market in [bot.MARKET_1, bot.MARKET_3, bot.MARKET_5, bot.MARKET_7]:
             if market in bot.orderbooks:
                 ob = bot.orderbooks[market]
-                bid = ob.buy_orders[0].price if ob.buy_orders else None
-                ask = ob.sell_orders[0].price if ob.sell_orders else None
+                bid, ask = ob.top()
                 spread = (ask - bid) if (bid and ask) else None
                 print(f"  {market:12}: bid={bid}, ask={ask}, spread={spread}")
             else:
@@ -80,8 +83,8 @@ try:
             print(f"    ETF bid={etf_bid}, ask={etf_ask}")
             print(f"    Synth bid={synth_bid}, ask={synth_ask}")
 
-        # Show current positions
-        positions = bot.get_positions()
+        # Show current positions (mirrored from the stream, reconciled in the background)
+        positions = bot.local_positions
         print("\n--- Positions ---")
         if positions:
             for product, pos in sorted(positions.items()):
@@ -89,8 +92,14 @@ try:
         else:
             print("  (flat - no positions)")
 
-        # Show PnL
-        pnl = bot.get_pnl()
+        # Show PnL - while flat with no new fills it cannot have moved, so skip the round trip.
+        # Fills are counted rather than inferred from positions: a round trip back to
+        # flat inside one print interval leaves positions unchanged but moves P&L.
+        fill_count = bot.fill_count
+        if not pnl or any(positions.values()) or fill_count != last_fill_count or positions != last_positions:
+            pnl = bot.get_pnl()
+        last_positions = positions
+        last_fill_count = fill_count
         if pnl:
             print(f"\nP&L: totalProfit={pnl.get('totalProfit', 0)}")
 